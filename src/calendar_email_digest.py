@@ -3,21 +3,60 @@
 """
 import argparse
 import ConfigParser
+try:
+    # Stdlib on Python 3; the 'futures' backport on Python 2.
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 import datetime
-import json
+import hashlib
 import logging
 import os
 import re
 import requests
+import stat
 import sys
+import tempfile
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 default_config_file = '/etc/calendar-email-digest.conf'
 
+_SESSION = requests.Session()
+# One host; keep enough pooled connections for refresh_all's worker threads.
+_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+
+_API_HEADERS = {
+    'Accept': 'application/json',
+    'Accept-Encoding': 'gzip',
+    # Google only compresses when the user agent advertises gzip by name.
+    'User-Agent': 'calendar-email-digest (gzip)',
+    }
+
+_URL_RE = re.compile(r'(https?:\/\/\S+?)(\.?([\s\n]|$))', re.I)
+_LINKIFY_RE = re.compile(
+    r'(?P<url>https?:\/\/\S+?)(?P<tail>\.?(?:[\s\n]|$))'
+    r'|(?P<email>[A-Za-z0-9._-]+@[A-Za-z0-9._-]+\.[A-Za-z0-9]+)', re.I)
+
+def _linkify(m):
+    """Turn a URL or email address match into the matching <a> tag."""
+    if m.group('url'):
+        return '<a href="%s">%s</a>%s' % (m.group('url'), m.group('url'), m.group('tail'))
+    return '<a href="mailto:%s">%s</a>' % (m.group('email'), m.group('email'))
+
 loglevels = [name for val, name in sorted(logging._levelNames.items()) if isinstance(name, str)]
 
 def loglevel(arg):
-    for level in logging._levelNames:
-        if isinstance(level, str) and level.startswith(arg.upper()):
+    prefix = arg.upper()
+    for level in loglevels:
+        if level.startswith(prefix):
             return level
     raise argparse.ArgumentTypeError('%r does not match any loglevel.' % arg)
 
@@ -91,37 +130,87 @@ optional_params = (
     )
 
 def get_url(key, calendar_id):
-    template = 'https://www.googleapis.com/calendar/v3/calendars/%(calendar_id)s/events?key=%(key)s&timeMin=%(rfc3339now)s&orderBy=startTime&singleEvents=true'
+    template = 'https://www.googleapis.com/calendar/v3/calendars/%(calendar_id)s/events?key=%(key)s&timeMin=%(rfc3339now)s&orderBy=startTime&singleEvents=true&fields=items(start,end,summary,description,htmlLink)'
     return template % dict(
         key=key,
         calendar_id=calendar_id,
-        rfc3339now=datetime.datetime.utcnow().isoformat()+'Z')
+        rfc3339now=datetime.datetime.utcnow().replace(second=0, microsecond=0).isoformat()+'Z')
 
 def parse_date(timespec):
     if 'date' in timespec:
         return timespec['date']
     return timespec['dateTime'][:10]
 
-def parse_url(event, linkprefs):
-    lines = [l.strip() for l in event.get('description', '').splitlines()]
-    for linkpref in linkprefs:
-        for line in lines:
-            parts = line.split(':', 1)
-            if len(parts) > 1 and parts[0].strip().lower() == linkpref:
-                m = re.search(r'(https?:\/\/\S+?)(\.?([\s\n]|$))', parts[1])
-                if m:
-                    return m.group(0)
-    return event['htmlLink']
-
-def parse_event(event, linkprefs):
+def parse_url(event, linkpref_priority):
+    description = event.get('description', '')
+    if 'http' not in description.lower():
+        return event['htmlLink']
+    best_priority = len(linkpref_priority)
+    best_url = None
+    get_priority = linkpref_priority.get
+    search = _URL_RE.search
+    for line in description.splitlines():
+        key, sep, rest = line.strip().partition(':')
+        if not sep:
+            continue
+        priority = get_priority(key.strip().lower())
+        if priority is not None and priority < best_priority:
+            m = search(rest)
+            if m:
+                best_priority = priority
+                best_url = m.group(0)
+    return best_url or event['htmlLink']
+
+_EVENT_FIELDS = ('start', 'end', 'datespec_html', 'datespec_plain', 'title',
+                 'summary', 'description', 'description_html', 'url')
+
+class Event(object):
+    """A parsed calendar event, slotted to avoid per-event dict overhead.
+
+    Implements keys/getitem so dict.update and the % templates consume
+    it exactly like the dict it replaces.
+    """
+    __slots__ = _EVENT_FIELDS
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def keys(self):
+        return _EVENT_FIELDS
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Event):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in _EVENT_FIELDS)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+def parse_event(event, linkpref_priority):
     description = event.get('description', '').strip()
-    return dict(
-        start = parse_date(event['start']),
-        end = parse_date(event['end']),
+    description_html = description
+    if '@' in description or 'http' in description.lower():
+        description_html = _LINKIFY_RE.sub(_linkify, description)
+    start = parse_date(event['start'])
+    end = parse_date(event['end'])
+    return Event(
+        start=start,
+        end=end,
+        datespec_html=start if start == end else start + " &ndash; " + end,
+        datespec_plain=start if start == end else start + " -- " + end,
         title=event['summary'].strip(),
-        summary=(description.splitlines() or [''])[0],
+        summary=description.partition('\n')[0].rstrip('\r'),
         description=description,
-        url=parse_url(event, linkprefs))
+        description_html=description_html.replace('\n', '<br>\n'),
+        url=parse_url(event, linkpref_priority))
 
 def datespec(event, sep):
     start = event['start']
@@ -130,41 +219,102 @@ def datespec(event, sep):
         return start
     return start + sep + end
 
-def html_summary(event, template):
-    return template % dict(event,
-        datespec=datespec(event, " &ndash; "))
-
-def html_details(event, index, template):
-    description = re.sub(r'(https?:\/\/\S+?)(\.?([\s\n]|$))', r'<a href="\1">\1</a>\2', event['description'], flags=re.I)
-    description = re.sub(r'([A-Za-z1-9-._]+@[A-Za-z1-9-._]+\.[A-Za-z1-9]+)', r'<a href="mailto:\1">\1</a>', description, flags=re.I)
-    return template % dict(event,
-        index=index,
-        datespec=datespec(event, " &ndash; "),
-        description=description.replace('\n', '<br>\n'))
-
-def generate_html_email(events, template, summary_template, details_template):
+_PLACEHOLDER_RE = re.compile(r'%\(([^)]+)\)[sd]')
+
+class _TemplateRenderer:
+    """A %(name)s template precompiled into literal segments and keys.
+
+    Renders with plain string concatenation instead of re-parsing the
+    format string on every event. Supports the % operator so it can be
+    used interchangeably with a plain template string.
+    """
+    def __init__(self, template):
+        parts = _PLACEHOLDER_RE.split(template)
+        self.segments = [s.replace('%%', '%') for s in parts[0::2]]
+        self.keys = parts[1::2]
+
+    def __call__(self, ctx):
+        segments = self.segments
+        out = []
+        for i, key in enumerate(self.keys):
+            value = ctx[key]
+            out.append(segments[i])
+            out.append(value if isinstance(value, basestring) else str(value))
+        out.append(segments[-1])
+        return ''.join(out)
+
+    __mod__ = __call__
+
+_template_cache = {}
+
+def _compile_template(template):
+    """Compile a template, reusing the renderer for identical template text.
+
+    Calendars sharing a template_dir get the same renderer objects
+    instead of one compiled copy per calendar. Templates using %
+    conversions the renderer does not precompile (widths, flags,
+    precision, conversions other than s/d) are returned unchanged and
+    keep going through the plain % operator.
+    """
+    try:
+        return _template_cache[template]
+    except KeyError:
+        pass
+    # Any % left in the literal segments (beyond escaped %%) is a
+    # conversion _PLACEHOLDER_RE did not recognize and would otherwise
+    # be emitted as literal text.
+    segments = _PLACEHOLDER_RE.split(template)[0::2]
+    if any('%' in segment.replace('%%', '') for segment in segments):
+        compiled = template
+    else:
+        compiled = _TemplateRenderer(template)
+    _template_cache[template] = compiled
+    return compiled
+
+def html_summary(event, template, ctx=None):
+    ctx = {} if ctx is None else ctx
+    ctx.update(event)
+    ctx['datespec'] = event['datespec_html']
+    return template % ctx
+
+def html_details(event, index, template, ctx=None):
+    ctx = {} if ctx is None else ctx
+    ctx.update(event)
+    ctx['index'] = index
+    ctx['datespec'] = event['datespec_html']
+    ctx['description'] = event['description_html']
+    return template % ctx
+
+def generate_html_email(events, template, summary_template, details_template, date=None):
+    ctx = {}
     return template % dict(
-        date=datetime.datetime.now().strftime("%Y-%m-%d"),
-        summary='\n'.join(html_summary(e, summary_template) for e in events),
-        details='\n'.join(html_details(e, i + 1, details_template) for i, e in enumerate(events)))
-
-def plaintext_summary(event, index, template):
-    return template % dict(event,
-        index=index,
-        indent=' ' * (len(str(index)) + 2),
-        datespec=datespec(event, " -- "))
-
-def plaintext_details(event, index, template):
-    return template % dict(event,
-        index=index,
-        datespec=datespec(event, " -- "))
-
-
-def generate_plaintext_email(events, template, summary_template, details_template):
+        date=date or datetime.date.today().isoformat(),
+        summary='\n'.join([html_summary(e, summary_template, ctx) for e in events]),
+        details='\n'.join([html_details(e, i + 1, details_template, ctx) for i, e in enumerate(events)]))
+
+def plaintext_summary(event, index, template, ctx=None):
+    ctx = {} if ctx is None else ctx
+    ctx.update(event)
+    ctx['index'] = index
+    ctx['indent'] = ' ' * (len(str(index)) + 2)
+    ctx['datespec'] = event['datespec_plain']
+    return template % ctx
+
+def plaintext_details(event, index, template, ctx=None):
+    ctx = {} if ctx is None else ctx
+    ctx.update(event)
+    ctx['index'] = index
+    ctx['indent'] = ' ' * (len(str(index)) + 2)
+    ctx['datespec'] = event['datespec_plain']
+    return template % ctx
+
+
+def generate_plaintext_email(events, template, summary_template, details_template, date=None):
+    ctx = {}
     return template % dict(
-        date=datetime.datetime.now().strftime("%Y-%m-%d"),
-        summary='\n'.join(plaintext_summary(e, i + 1, summary_template) for i, e in enumerate(events)),
-        details=('\n\n' + '-'*75 + '\n\n').join(plaintext_details(e, i + 1, details_template) for i, e in enumerate(events)))
+        date=date or datetime.date.today().isoformat(),
+        summary='\n'.join([plaintext_summary(e, i + 1, summary_template, ctx) for i, e in enumerate(events)]),
+        details=('\n\n' + '-'*75 + '\n\n').join([plaintext_details(e, i + 1, details_template, ctx) for i, e in enumerate(events)]))
 
 def compose_email(sender, recipient, subject, html, plaintext):
     from email.mime.multipart import MIMEMultipart
@@ -180,23 +330,55 @@ def compose_email(sender, recipient, subject, html, plaintext):
     msg.attach(MIMEText(html, 'html', "utf-8"))
     return msg
 
-def send_email(msg, smtp_server='localhost', smtp_port=0, smtp_username=None, smtp_password=None):
-    import smtplib
-    s = smtplib.SMTP(smtp_server, smtp_port)
-    if smtp_username:
-        s.login(smtp_username, smtp_password)
-    s.sendmail(msg['From'], msg['To'], msg.as_string())
-    s.quit()
+class SMTPSender:
+    """One SMTP session that can deliver several messages.
+
+    Opening the connection (and TLS + AUTH when credentials are given)
+    happens once; send() resets the session between messages, so batch
+    callers pay the handshake a single time.
+    """
+    def __init__(self, smtp_server='localhost', smtp_port=0, smtp_username=None, smtp_password=None):
+        import smtplib
+        self.connection = smtplib.SMTP(smtp_server, smtp_port)
+        if smtp_username:
+            self.connection.starttls()
+            self.connection.login(smtp_username, smtp_password)
+        self._sent = False
+
+    def send(self, msg, msg_string=None):
+        if self._sent:
+            self.connection.rset()
+        self.connection.sendmail(msg['From'], msg['To'], msg_string or msg.as_string())
+        self._sent = True
+
+    def close(self):
+        self.connection.quit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def send_email(msg, smtp_server='localhost', smtp_port=0, smtp_username=None, smtp_password=None, msg_string=None):
+    with SMTPSender(smtp_server, smtp_port, smtp_username, smtp_password) as sender:
+        sender.send(msg, msg_string)
 
 def add_arguments(parser, argspecs):
     for names, specs in argspecs:
         parser.add_argument(*names, **specs)
 
+_optionxform_cache = {}
+
 def _optionxform(optionname):
-    """Used by the configfile parsers."""
-    return optionname.lower().replace('-', '_')
+    """Used by the configfile parsers. Memoized; option names repeat."""
+    try:
+        return _optionxform_cache[optionname]
+    except KeyError:
+        result = _optionxform_cache[optionname] = optionname.lower().replace('-', '_')
+        return result
 
-def get_config(args):
+def get_config(args, defaults_dict=None):
     def attrname(argname):
         return argname.strip('-').replace('-', '_')
 
@@ -215,74 +397,185 @@ def get_config(args):
     add_arguments(conf_parser.add_argument_group('optional'), optional_params)
 
     defaults = dict()
-    if os.path.isfile(default_config_file):
-        config_files.insert(0, open(default_config_file))
-    if config_files:
-        if not section:
-            conf_parser.error('Section not specified.')
-        cfp = ConfigParser.SafeConfigParser()
-        cfp.optionxform = _optionxform
-        cfp.read(f.name for f in config_files)
-        if cfp.has_section(section):
-            defaults = {attrname(k):v for k, v in cfp.items(section)}
+    if defaults_dict is not None:
+        defaults = {attrname(k):v for k, v in defaults_dict.items()}
+    else:
+        if os.path.isfile(default_config_file):
+            config_files.insert(0, open(default_config_file))
+        if config_files:
+            if not section:
+                conf_parser.error('Section not specified.')
+            cfp = ConfigParser.SafeConfigParser()
+            cfp.optionxform = _optionxform
+            cfp.read(f.name for f in config_files)
+            if cfp.has_section(section):
+                defaults = {attrname(k):v for k, v in cfp.items(section)}
 
     argparser = argparse.ArgumentParser(parents=[conf_parser], description=__doc__, add_help=False)
     argparser.set_defaults(**defaults)
     config = argparser.parse_args(remaining_argv)
     config.linkprefs = [s.strip() for s in config.linkprefs.split(',')]
+    config.linkpref_priority = {lp.lower(): i for i, lp in enumerate(config.linkprefs)}
 
     for argnames, _ in params:
         if not getattr(config, attrname(argnames[0])):
             argparser.error("%s/%s not specified." % argnames)
 
+    missing = []
     for (long, _), _ in template_params:
         attr = attrname(long)
-        if getattr(config, attr):
+        template = getattr(config, attr)
+        if template:
+            if hasattr(template, 'read'):
+                setattr(config, attr, template.read())
             continue
         if not os.path.isdir(config.template_dir):
             argparser.error("%s template not specified." % long)
-        try:
-            f = open(os.path.join(config.template_dir, attr + '.templ'))
-        except:
-            argparser.error("%s template not specified, and no %s.templ present in template_dir %r." % (long, attr, config.template_dir))
-        setattr(config, attr, f.read())
+        missing.append((long, attr))
+
+    if missing:
+        def read_template(item):
+            long, attr = item
+            try:
+                return open(os.path.join(config.template_dir, attr + '.templ')).read()
+            except:
+                return None
+        if ThreadPoolExecutor is None:
+            texts = [read_template(item) for item in missing]
+        else:
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                texts = list(executor.map(read_template, missing))
+        for (long, attr), text in zip(missing, texts):
+            if text is None:
+                argparser.error("%s template not specified, and no %s.templ present in template_dir %r." % (long, attr, config.template_dir))
+            setattr(config, attr, text)
+
+    for attr in ('html_template', 'html_summary', 'html_details',
+                 'plaintext_template', 'plaintext_summary', 'plaintext_details'):
+        setattr(config, attr, _compile_template(getattr(config, attr)))
 
     return config
 
-def get_events(config):
+def fetch_events(config, etag=None):
+    """Fetch and parse upcoming events, returning (events, etag).
+
+    When the given etag still matches on the server the reply is an
+    empty 304 and events is None; the caller keeps whatever it parsed
+    last time.
+    """
     url = get_url(config.key, config.calendar_id)
     logging.debug("API url %r.", url)
-    text = requests.get(url).text
-    raw = json.loads(text)
+    headers = dict(_API_HEADERS)
+    if etag:
+        headers['If-None-Match'] = etag
+    resp = _SESSION.get(url, timeout=30, headers=headers)
+    if resp.status_code == 304:
+        logging.debug("Calendar unchanged (304).")
+        return None, etag
+    try:
+        raw = _json.loads(resp.content)
+    except ValueError:
+        raw = {}
     if not 'items' in raw:
-        logging.fatal('Unexpected response from Google Calendar API:\n' + text)
+        logging.fatal('Unexpected response from Google Calendar API:\n%s', resp.content)
         raise RuntimeError('Unexpected response from Google Calendar API.')
-    return [parse_event(e, config.linkprefs) for e in raw['items']]
+    parse = parse_event
+    linkpref_priority = config.linkpref_priority
+    return [parse(e, linkpref_priority) for e in raw['items']], resp.headers.get('ETag', '')
 
-def format_events(config, events):
+def get_events(config):
+    events, _ = fetch_events(config)
+    return events
+
+def render_plaintext(config, events, date=None):
     logging.debug("Generating plaintext message.")
-    plaintext = generate_plaintext_email(
-        events, config.plaintext_template, config.plaintext_summary, config.plaintext_details)
+    return generate_plaintext_email(
+        events, config.plaintext_template, config.plaintext_summary, config.plaintext_details, date)
+
+def render_html(config, events, date=None):
     logging.debug("Generating HTML message.")
-    html = generate_html_email(
-        events, config.html_template, config.html_summary, config.html_details)
+    return generate_html_email(
+        events, config.html_template, config.html_summary, config.html_details, date)
+
+def build_email(config, plaintext, html):
     logging.debug("Composing multipart email.")
-    email = compose_email(config.sender, config.recipient, config.subject, html, plaintext)
+    return compose_email(config.sender, config.recipient, config.subject, html, plaintext)
+
+def generate_emails(config, events, date=None):
+    """Render the plaintext and HTML bodies in a single pass over the events.
+
+    One ctx dict per template kind, so every render sees exactly the ctx
+    contents it would get from generate_html_email/generate_plaintext_email.
+    """
+    logging.debug("Generating plaintext and HTML messages.")
+    date = date or datetime.date.today().isoformat()
+    html_summaries = []
+    html_details_parts = []
+    plain_summaries = []
+    plain_details_parts = []
+    hs_ctx, hd_ctx, ps_ctx, pd_ctx = {}, {}, {}, {}
+    for i, event in enumerate(events):
+        index = i + 1
+        html_summaries.append(html_summary(event, config.html_summary, hs_ctx))
+        html_details_parts.append(html_details(event, index, config.html_details, hd_ctx))
+        plain_summaries.append(plaintext_summary(event, index, config.plaintext_summary, ps_ctx))
+        plain_details_parts.append(plaintext_details(event, index, config.plaintext_details, pd_ctx))
+    html = config.html_template % dict(
+        date=date,
+        summary='\n'.join(html_summaries),
+        details='\n'.join(html_details_parts))
+    plaintext = config.plaintext_template % dict(
+        date=date,
+        summary='\n'.join(plain_summaries),
+        details=('\n\n' + '-'*75 + '\n\n').join(plain_details_parts))
+    return plaintext, html
+
+def format_events(config, events):
+    plaintext, html = generate_emails(config, events)
+    email = build_email(config, plaintext, html)
     return plaintext, html, email
 
+_HTML_MSG_PREFIX = b'<html><head><title>'
+_HTML_MSG_MID1 = b'</title></head><body><h1>'
+_HTML_MSG_MID2 = b'</h1>'
+_HTML_MSG_SUFFIX = b'</body></html>'
+
 class WSGIApplication:
+    _CONFIG_CACHE = {}
+
     def __init__(self, wsgi_section='wsgi', config_files=None, configs=None):
         self.configs = dict(configs or {})
-        self.configs.update(self.get_calendar_configs(wsgi_section, config_files))
+        self._wsgi_section = wsgi_section
+        self._config_files = config_files
+        file_configs, self.cache_ttl = self.get_calendar_configs(wsgi_section, config_files)
+        self.configs.update(file_configs)
+        self._cache = {}
+        self._etags = {}
+
+    def reload(self):
+        """Re-read the config files and drop any cached digests."""
+        self._CONFIG_CACHE.clear()
+        file_configs, self.cache_ttl = self.get_calendar_configs(self._wsgi_section, self._config_files)
+        self.configs.update(file_configs)
+        self._cache.clear()
+        self._etags.clear()
 
     @classmethod
     def get_calendar_configs(cls, wsgi_section, config_files):
-        config_files = config_files or []
+        config_files = list(config_files or [])
         if os.path.isfile(default_config_file):
             config_files.insert(0, default_config_file)
         wsgi_config = ConfigParser.SafeConfigParser()
         wsgi_config.optionxform = _optionxform
         wsgi_config.read(config_files)
+        # The resolved configs embed the template texts, so both caches must
+        # be invalidated when a template file changes, not just the .conf:s.
+        template_files = cls._template_files(wsgi_config)
+        cache_key = (wsgi_section,
+                     tuple((f, os.path.getmtime(f)) for f in config_files),
+                     tuple((f, os.path.getmtime(f)) for f in template_files))
+        if cache_key in cls._CONFIG_CACHE:
+            return cls._CONFIG_CACHE[cache_key]
         def get(option, default=''):
             try:
                 return wsgi_config.get(wsgi_section, option)
@@ -294,8 +587,113 @@ class WSGIApplication:
             raise ValueError(msg % (wsgi_section, config_files))
         wsgi_calendars = [c.strip() for c in raw.split(',')]
         configure_logging(get('logfile', sys.stderr), getattr(logging, get('loglevel', 'info').upper()))
-        args = sum((['--config-file', f] for f in config_files), []) + ['--no-send', '-s']
-        return {c:get_config(args + [c]) for c in wsgi_calendars}
+        result = cls._load_pickled_configs(config_files + template_files)
+        if result is None:
+            sections = {s: dict(wsgi_config.items(s)) for s in wsgi_config.sections()}
+            result = ({c:get_config(['--no-send'], defaults_dict=sections.get(c, {})) for c in wsgi_calendars},
+                      int(get('cache_ttl', 300)))
+            cls._dump_pickled_configs(config_files + template_files, result)
+        cls._CONFIG_CACHE[cache_key] = result
+        return result
+
+    @classmethod
+    def _template_files(cls, wsgi_config):
+        """Template files the resolved configs will embed the contents of."""
+        template_attrs = ('html_template', 'html_summary', 'html_details',
+                          'plaintext_template', 'plaintext_summary', 'plaintext_details')
+        files = set()
+        for section in wsgi_config.sections():
+            for attr in template_attrs:
+                try:
+                    files.add(wsgi_config.get(section, attr))
+                except:
+                    pass
+            try:
+                template_dir = wsgi_config.get(section, 'template_dir')
+            except:
+                continue
+            for attr in template_attrs:
+                files.add(os.path.join(template_dir, attr + '.templ'))
+        return sorted(f for f in files if os.path.isfile(f))
+
+    @classmethod
+    def _pickle_dir(cls):
+        """Per-user private directory for the resolved-config cache.
+
+        The cache holds credentials (API key, SMTP password) and is fed to
+        pickle.load() on boot, so it must not be readable or plantable by
+        other users. Returns None (disabling the cache) if the directory
+        cannot be made private.
+        """
+        path = os.path.join(tempfile.gettempdir(), 'calendar-email-digest-%s' % os.getuid())
+        try:
+            os.mkdir(path, 0o700)
+        except OSError:
+            pass
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            logging.warning("Not caching configs: %r is not a private directory we own.", path)
+            return None
+        return path
+
+    @classmethod
+    def _pickle_path(cls, source_files):
+        cachedir = cls._pickle_dir()
+        if cachedir is None:
+            return None
+        sig = hashlib.sha1(b''.join(open(f, 'rb').read() for f in source_files)).hexdigest()
+        return os.path.join(cachedir, 'configs-%s.pkl' % sig)
+
+    @classmethod
+    def _load_pickled_configs(cls, source_files):
+        """Reload configs resolved by an earlier process from identical files."""
+        path = cls._pickle_path(source_files)
+        if path is None:
+            return None
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        except OSError:
+            return None
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+            # Never unpickle a file someone else could have written.
+            logging.warning("Ignoring config cache %r: unexpected owner or mode.", path)
+            os.close(fd)
+            return None
+        try:
+            with os.fdopen(fd, 'rb') as f:
+                configs, cache_ttl = pickle.load(f)
+        except:
+            return None
+        for config in configs.values():
+            config.logfile = sys.stderr
+        return configs, cache_ttl
+
+    @classmethod
+    def _dump_pickled_configs(cls, source_files, result):
+        path = cls._pickle_path(source_files)
+        if path is None:
+            return
+        configs, cache_ttl = result
+        for config in configs.values():
+            config.logfile = None
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+        except:
+            logging.debug("Could not save resolved configs for reuse.")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        for config in configs.values():
+            config.logfile = sys.stderr
 
     def __call__(self, environ, start_response):
         try:
@@ -304,16 +702,55 @@ class WSGIApplication:
             from traceback import format_exc
             logging.error(format_exc())
             status = '500 Internal server error'
-            body = self._html_msg(status, 'Please contact the server administrator.').encode('utf-8')
+            body = self._html_msg(status, 'Please contact the server administrator.')
             headers = [('Content-Type', 'text/html; charset=UTF-8')]
-        body = body.encode('utf-8')
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
         headers += [('Content-Length', str(len(body)))]
         start_response(status, headers)
         return [body]
 
+    def refresh_all(self):
+        """Fetch all calendars in parallel, refilling the event cache."""
+        if not self.configs:
+            return
+        def refresh(cal):
+            self._refresh(cal, time.time())
+        if ThreadPoolExecutor is None:
+            for cal in self.configs:
+                refresh(cal)
+            return
+        with ThreadPoolExecutor(max_workers=min(8, len(self.configs))) as executor:
+            list(executor.map(refresh, self.configs))
+
+    def _refresh(self, cal, now):
+        """Fetch a calendar (conditionally on its last etag) and cache the render.
+
+        The cached renders survive both a 304 and a refetch that parses
+        into the same events, so identical content is never rendered twice.
+        """
+        config = self.configs[cal]
+        events, etag = fetch_events(config, self._etags.get(cal))
+        cached = self._cache.get(cal)
+        if events is None and not cached:
+            events, etag = fetch_events(config)
+        if events is None or (cached and events == cached[1]):
+            entry = (now + self.cache_ttl,) + cached[1:]
+        else:
+            logging.info("Found %s events in %s", len(events), cal)
+            entry = (now + self.cache_ttl, events, {})
+        self._etags[cal] = etag
+        self._cache[cal] = entry
+        return entry
+
     @classmethod
     def _html_msg(cls, heading, details=''):
-        return "<html><head><title>%s</title></head><body><h1>%s</h1>%s</body></html>" % (heading, heading, details)
+        if not isinstance(heading, bytes):
+            heading = heading.encode('utf-8')
+        if not isinstance(details, bytes):
+            details = details.encode('utf-8')
+        return (_HTML_MSG_PREFIX + heading + _HTML_MSG_MID1 + heading
+                + _HTML_MSG_MID2 + details + _HTML_MSG_SUFFIX)
 
     def process_request(self, environ, start_response):
         status = '200 OK'
@@ -331,18 +768,40 @@ class WSGIApplication:
             status = '404 Not found'
             body = self._html_msg(status)
             return status, headers, body
-        events = get_events(self.configs[cal])
-        logging.info("Found %s events", len(events))
-        plaintext, html, email = format_events(self.configs[cal], events)
+        now = time.time()
+        entry = self._cache.get(cal)
+        if not entry or entry[0] <= now:
+            entry = self._refresh(cal, now)
+        events, renders = entry[1], entry[2]
+        config = self.configs[cal]
         if fmt == '.html':
-            return status, headers, html
+            if 'html' not in renders:
+                renders['html'] = render_html(config, events)
+            return status, headers, renders['html']
         if fmt == '.txt':
-            return status, [('Content-Type', 'text/plain; charset=UTF-8')], plaintext
+            if 'plaintext' not in renders:
+                renders['plaintext'] = render_plaintext(config, events)
+            return status, [('Content-Type', 'text/plain; charset=UTF-8')], renders['plaintext']
         if fmt == '.eml':
-            return status, [('Content-Type', email.get_content_type())], email.as_string()
+            if 'eml' not in renders:
+                from email.generator import Generator
+                from io import BytesIO
+                if 'plaintext' not in renders:
+                    renders['plaintext'] = render_plaintext(config, events)
+                if 'html' not in renders:
+                    renders['html'] = render_html(config, events)
+                email = build_email(config, renders['plaintext'], renders['html'])
+                buf = BytesIO()
+                Generator(buf, mangle_from_=False).flatten(email)
+                renders['eml'] = (email.get_content_type(), buf.getvalue())
+            content_type, body = renders['eml']
+            return status, [('Content-Type', content_type)], body
         raise RuntimeError("Unreachable code reached.")
 
 def configure_logging(stream, level):
+    if logging.getLogger().handlers:
+        # Already configured; don't stack handlers when the WSGI app is re-instantiated.
+        return
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', stream=stream, level=level)
 
 def main(config):
@@ -361,14 +820,17 @@ def main(config):
     if config.htmlfile:
         logging.debug("Saving html copy to %s.", config.htmlfile.name)
         config.htmlfile.write(html)
+    email_string = None
     if config.emailfile:
         logging.debug("Saving email copy to %s.", config.emailfile.name)
-        config.emailfile.write(email.as_string())
+        email_string = email.as_string()
+        config.emailfile.write(email_string)
     if config.no_send:
         logging.info("Dry run requested, not sending email.")
         return 0
     logging.debug("Sending email.")
-    send_email(email, config.host, config.port, config.username, config.password)
+    send_email(email, config.host, config.port, config.username, config.password,
+               msg_string=email_string)
     return 0
 
 if __name__ == '__main__':